@@ -14,10 +14,16 @@ import os
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib.dates import AutoDateLocator, DateFormatter
 from datetime import date
 from jqdata import *
 
+try:
+    import bottleneck as bn  # optional: C forward-fill / moving median
+except ImportError:
+    bn = None
+
 # ------------------ Utilities ------------------
 def _ensure_dir(path: str) -> None:
     """Create directory if missing."""
@@ -26,8 +32,49 @@ def _ensure_dir(path: str) -> None:
 
 def _to_float_clean(s: pd.Series) -> pd.Series:
     """Convert to float, drop NaN/±inf; keep index alignment."""
-    s = pd.to_numeric(s, errors='coerce').astype('float64')
-    return s.replace([np.inf, -np.inf], np.nan).dropna()
+    v = pd.to_numeric(s, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    m = np.isfinite(v)  # single mask for NaN and ±inf
+    return pd.Series(v[m], index=s.index[m], name=s.name)
+
+def _align_inner(*series: pd.Series, skip_empty: bool = False):
+    """
+    Restrict series to their common dates with one inner join.
+    With skip_empty, empty series after the first are left out of the join
+    and returned unchanged.
+    """
+    keep = [i for i, s in enumerate(series) if i == 0 or not (skip_empty and s.empty)]
+    aligned = pd.concat([series[i] for i in keep], axis=1, join='inner', keys=keep)
+    out = list(series)
+    for i in keep:
+        out[i] = aligned[i].rename(series[i].name)
+    return tuple(out)
+
+def _ffill(s: pd.Series) -> pd.Series:
+    """Forward-fill NaNs of a numeric series (bottleneck.push if installed)."""
+    v = pd.to_numeric(s, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    if bn is not None:
+        v = bn.push(v)
+    else:
+        # index of the last non-NaN position seen so far, then gather
+        pos = np.where(np.isnan(v), 0, np.arange(len(v)))
+        np.maximum.accumulate(pos, out=pos)
+        v = v[pos]
+    return pd.Series(v, index=s.index, name=s.name)
+
+def _rolling_median(s: pd.Series, window: int) -> pd.Series:
+    """
+    Centered rolling median over full windows, NaN rows dropped
+    (same result as s.rolling(window, center=True).median().dropna()).
+    """
+    if bn is None:
+        return s.rolling(window, center=True).median().dropna()
+    if len(s) < window:
+        return s.iloc[:0]
+    med = bn.move_median(s.to_numpy(dtype='float64'), window=window)  # trailing window
+    shift = (window - 1) // 2                                          # trailing -> centered
+    out = np.full(len(med), np.nan)
+    out[:len(med) - shift] = med[shift:]
+    return pd.Series(out, index=s.index, name=s.name).dropna()
 
 # ------------------ Data fetching: PE/PB ------------------
 def _fetch_valuation_block(stocks, end_dt, count) -> pd.DataFrame:
@@ -51,52 +98,50 @@ def _fetch_valuation_daily_loop(stock: str, trade_days) -> pd.DataFrame:
     """
     q = query(valuation.code, valuation.pe_ratio, valuation.pb_ratio) \
         .filter(valuation.code == stock)
-    rec = []
+    # Preallocated column arrays instead of one dict per row
+    n = len(trade_days)
+    dates = np.empty(n, dtype='datetime64[ns]')
+    pe = np.empty(n, dtype='float64')
+    pb = np.empty(n, dtype='float64')
+    j = 0
     for d in trade_days:
         tmp = get_fundamentals(q, date=d)
         if tmp is None or tmp.empty:
             continue
         row = tmp.iloc[0]
-        rec.append({
-            'date': pd.to_datetime(d),
-            'code': stock,
-            'pe_ratio': row['pe_ratio'],
-            'pb_ratio': row['pb_ratio']
-        })
-    if not rec:
+        dates[j] = np.datetime64(pd.to_datetime(d), 'ns')
+        pe[j] = row['pe_ratio']
+        pb[j] = row['pb_ratio']
+        j += 1
+    if j == 0:
         return (pd.DataFrame(columns=['date', 'code', 'pe_ratio', 'pb_ratio'])
                   .set_index(['date', 'code']))
-    return pd.DataFrame(rec).set_index(['date', 'code']).sort_index()
+    index = pd.MultiIndex.from_arrays([dates[:j], np.full(j, stock, dtype=object)],
+                                      names=['date', 'code'])
+    return pd.DataFrame({'pe_ratio': pe[:j], 'pb_ratio': pb[:j]}, index=index).sort_index()
 
-def _prep_single_stock(df_all: pd.DataFrame, stock: str, trade_days, resample=None):
+def _prep_single_stock(df: pd.DataFrame, trade_days, resample=None):
     """
-    Extract single ticker from the big valuation table, align to trading days,
+    Take one ticker's valuation rows (date index), align to trading days,
     forward-fill gaps, clean to float, and optionally resample.
     Returns: (pe_series, pb_series)
     """
-    try:
-        df = df_all.xs(stock, level='code')
-    except Exception:
-        df = pd.DataFrame(columns=['pe_ratio', 'pb_ratio'])
-
     # Deduplicate by date, keep last, set date index, align to all trading days
     df = (df.reset_index()
             .drop_duplicates(subset=['date'], keep='last')
             .set_index('date')
             .sort_index())
-    df = df.reindex(pd.to_datetime(trade_days)).ffill()
+    df = df.reindex(pd.to_datetime(trade_days))
 
-    pe = _to_float_clean(df.get('pe_ratio', pd.Series(index=df.index, dtype='float64')))
-    pb = _to_float_clean(df.get('pb_ratio', pd.Series(index=df.index, dtype='float64')))
-    idx = pe.index.intersection(pb.index)
-    pe, pb = pe.loc[idx], pb.loc[idx]
+    pe = _to_float_clean(_ffill(df.get('pe_ratio', pd.Series(index=df.index, dtype='float64'))))
+    pb = _to_float_clean(_ffill(df.get('pb_ratio', pd.Series(index=df.index, dtype='float64'))))
+    pe, pb = _align_inner(pe, pb)
 
     # Optional resample to weekly/monthly (take last obs per period)
     if resample in ['W', 'M']:
         pe = pe.resample(resample).last().dropna()
         pb = pb.resample(resample).last().dropna()
-        idx = pe.index.intersection(pb.index)
-        pe, pb = pe.loc[idx], pb.loc[idx]
+        pe, pb = _align_inner(pe, pb)
 
     return pe, pb
 
@@ -124,6 +169,7 @@ def plot_pe_pb_with_price_batch(
     smooth_window=3,
     out_dir='pepb_out',
     combined_csv='pepb_combined.csv',
+    per_ticker_csv=True,
     show=True,
     max_cols=2,
     figsize_per_plot=(6.6, 3.9),
@@ -138,8 +184,9 @@ def plot_pe_pb_with_price_batch(
         price_indexed: True to index price to 100 at first point
         smooth_window: median window size for display smoothing (1 disables)
         out_dir: CSV output directory
-        combined_csv: name of combined CSV file
-        show: show the figure
+        combined_csv: name of combined CSV file (None to skip)
+        per_ticker_csv: also write one CSV per ticker
+        show: show the figure; if False, render off-screen and return the Figure
         max_cols: subplots per row
         figsize_per_plot: size per subplot (width, height)
     """
@@ -168,14 +215,22 @@ def plot_pe_pb_with_price_batch(
         if df_all is None or df_all.empty:
             raise RuntimeError('Failed to fetch valuation data.')
 
+    # Split the big table by ticker once (instead of an xs() per ticker in the loop)
+    empty_val = pd.DataFrame(columns=['pe_ratio', 'pb_ratio'],
+                             index=pd.DatetimeIndex([], name='date'))
+    val_by_code = {code: grp.droplevel('code')
+                   for code, grp in df_all.groupby(level='code', sort=False)}
+
     # Figure canvas
     n = len(stocks)
     rows = (n + max_cols - 1) // max_cols
-    fig, axes = plt.subplots(
-        rows, max_cols,
-        figsize=(figsize_per_plot[0] * max_cols, figsize_per_plot[1] * rows),
-        squeeze=False
-    )
+    figsize = (figsize_per_plot[0] * max_cols, figsize_per_plot[1] * rows)
+    if show:
+        fig, axes = plt.subplots(rows, max_cols, figsize=figsize, squeeze=False)
+    else:
+        # Off-screen: plain Figure (Agg canvas), skips pyplot's GUI backend/figure manager
+        fig = Figure(figsize=figsize)
+        axes = fig.subplots(rows, max_cols, squeeze=False)
 
     locator = AutoDateLocator()
     formatter = DateFormatter('%Y-%m')
@@ -189,16 +244,11 @@ def plot_pe_pb_with_price_batch(
         ax2 = ax1.twinx()  # right Y for PB
 
         # Prepare PE/PB/Price
-        pe, pb = _prep_single_stock(df_all, stock, trade_days, resample=resample)
+        pe, pb = _prep_single_stock(val_by_code.get(stock, empty_val), trade_days, resample=resample)
         px = _get_price_series(stock, start_ts, end_ts, resample=resample)
 
-        # Align to common dates (intersection)
-        idx = pe.index
-        if not pb.empty:
-            idx = idx.intersection(pb.index)
-        if not px.empty:
-            idx = idx.intersection(px.index)
-        pe, pb, px = pe.loc[idx], pb.loc[idx], px.loc[idx]
+        # Align to common dates (one inner join; empty PB/price are left out)
+        pe, pb, px = _align_inner(pe, pb, px, skip_empty=True)
 
         if px.empty or (pe.empty and pb.empty):
             ax1.text(0.5, 0.5, f"{stock}\nNo usable data",
@@ -217,19 +267,12 @@ def plot_pe_pb_with_price_batch(
 
         # Optional visual smoothing (median)
         if smooth_window and smooth_window > 1:
-            def _med(s): return s.rolling(smooth_window, center=True).median().dropna()
+            def _med(s): return _rolling_median(s, smooth_window)
             pe_p = _med(pe) if not pe.empty else pe
             pb_p = _med(pb) if not pb.empty else pb
             px_p = _med(px_plot)
 
-            idx2 = px_p.index
-            if not pe_p.empty:
-                idx2 = idx2.intersection(pe_p.index)
-            if not pb_p.empty:
-                idx2 = idx2.intersection(pb_p.index)
-            pe_plot = pe_p.loc[idx2] if not pe_p.empty else pe_p
-            pb_plot = pb_p.loc[idx2] if not pb_p.empty else pb_p
-            px_plot = px_p.loc[idx2]
+            px_plot, pe_plot, pb_plot = _align_inner(px_p, pe_p, pb_p, skip_empty=True)
         else:
             pe_plot, pb_plot = pe, pb
 
@@ -247,19 +290,14 @@ def plot_pe_pb_with_price_batch(
         if not px_plot.empty:
             ax1.plot(px_plot.index, px_plot.values, color=color_px, lw=1.4, linestyle=':', label=px_label)
 
-        # Shaded mean ± 1σ bands (use constant arrays to avoid dtype issues)
+        # Shaded mean ± 1σ bands: constant ribbons, so one axhspan rectangle each
+        # (no per-point arrays to build or polygons to draw)
         if not np.isnan(pe_avg) and len(pe_plot) > 2:
-            x1 = pe_plot.index
-            ax1.fill_between(x1,
-                             np.full(len(x1), pe_avg - pe_std),
-                             np.full(len(x1), pe_avg + pe_std),
-                             color=color_pe, alpha=0.10, label='PE mean ± 1σ')
+            ax1.axhspan(pe_avg - pe_std, pe_avg + pe_std,
+                        color=color_pe, alpha=0.10, label='PE mean ± 1σ')
         if not np.isnan(pb_avg) and len(pb_plot) > 2:
-            x2 = pb_plot.index
-            ax2.fill_between(x2,
-                             np.full(len(x2), pb_avg - pb_std),
-                             np.full(len(x2), pb_avg + pb_std),
-                             color=color_pb, alpha=0.10, label='PB mean ± 1σ')
+            ax2.axhspan(pb_avg - pb_std, pb_avg + pb_std,
+                        color=color_pb, alpha=0.10, label='PB mean ± 1σ')
 
         # Cosmetics
         ax1.set_title(stock)
@@ -281,14 +319,14 @@ def plot_pe_pb_with_price_batch(
         out_df = pd.DataFrame({'PE': pe, 'PB': pb, 'Close': px})
         if price_indexed and not px.empty:
             out_df['Close_indexed_100'] = (px / px.iloc[0]) * 100.0
-        out_df.to_csv(os.path.join(out_dir, f"jq_pepb_{stock.replace('.', '')}.csv"),
-                      encoding='utf-8-sig')
+        if per_ticker_csv:
+            out_df.to_csv(os.path.join(out_dir, f"jq_pepb_{stock.replace('.', '')}.csv"),
+                          encoding='utf-8-sig')
 
-        # For combined CSV (optional extension)
-        tmp = out_df.copy()
-        tmp['code'] = stock
-        tmp['date'] = tmp.index
-        combined_rows.append(tmp.reset_index(drop=True))
+        # For combined CSV (written once after the loop)
+        if combined_csv:
+            combined_rows.append(out_df.assign(code=stock, date=out_df.index)
+                                       .reset_index(drop=True))
 
     # Hide any empty axes
     for j in range(n, rows * max_cols):
@@ -305,11 +343,13 @@ def plot_pe_pb_with_price_batch(
     if show:
         plt.show()
 
-    # Optional: combined CSV (uncomment if desired)
-    # if combined_rows:
-    #     combined = pd.concat(combined_rows, ignore_index=True)
-    #     combined.to_csv(os.path.join(out_dir, combined_csv),
-    #                     encoding='utf-8-sig', index=False)
+    # Combined CSV: one concat + one write for all tickers
+    if combined_csv and combined_rows:
+        combined = pd.concat(combined_rows, ignore_index=True)
+        combined.to_csv(os.path.join(out_dir, combined_csv),
+                        encoding='utf-8-sig', index=False)
+
+    return None if show else fig
 
 # ------------------ Example Run ------------------
 if __name__ == '__main__':
@@ -9,7 +9,9 @@ Modify them in set_params(context). Everything else can stay as-is.
 from jqlib.technical_analysis import *
 from jqfactor import *
 from jqdata import *
-import datetime as dt
+import functools
+from collections import namedtuple
+import numpy as np
 import pandas as pd
 
 
@@ -24,6 +26,11 @@ def set_params(context):
     g.open_max_2 = -3.0   # upper bound, e.g. -3.0
 
 
+# Per-order print lines (with separators); off by default so the 09:30 order
+# loop only sends orders, and one summary log line is written afterwards.
+DEBUG_ORDERS = False
+
+
 # ===================== Initialize =====================
 def initialize(context):
     # Benchmark
@@ -43,8 +50,9 @@ def initialize(context):
 # ===================== Buy =====================
 def buy(context):
     date = get_previous_trade_day(context, 0)
-    stock_list_with_ST = prepare_stock_list(context)
-    stock_list_not_ST  = prepare_stock_list2(context)
+    prefetched = prepare_shared_stock_list(context)   # one set of shared RPCs for both pools
+    stock_list_with_ST = prepare_stock_list(context, prefetched)
+    stock_list_not_ST  = prepare_stock_list2(context, prefetched)
 
     # keep order & dedup
     stock_list = list(dict.fromkeys(stock_list_with_ST + stock_list_not_ST))
@@ -55,8 +63,10 @@ def buy(context):
         if cash > 0:
             for s in stock_list:
                 order_target_value(s, cash / len(stock_list))
-                print('买入', [get_security_info(s, date).display_name, s])
-                print('———————————————————————————————————')
+                if DEBUG_ORDERS:
+                    print('买入', [_display_name(s, date), s])
+                    print('———————————————————————————————————')
+            log_orders('买入', stock_list, date)
         else:
             print("当前账户没有现金,无法买入")
 
@@ -66,6 +76,8 @@ def sell(context):
     date = get_previous_trade_day(context, 0)
     current_data = get_current_data()
 
+    take_profit, stop_loss = [], []
+
     # AM take-profit
     if str(context.current_dt)[-8:] == '11:25:00':
         for s in list(context.portfolio.positions):
@@ -73,8 +85,10 @@ def sell(context):
                 (current_data[s].last_price < current_data[s].high_limit) and
                 (current_data[s].last_price > context.portfolio.positions[s].avg_cost)):
                 order_target_value(s, 0)
-                print('止盈卖出', [get_security_info(s, date).display_name, s])
-                print('———————————————————————————————————')
+                take_profit.append(s)
+                if DEBUG_ORDERS:
+                    print('止盈卖出', [_display_name(s, date), s])
+                    print('———————————————————————————————————')
 
     # PM exit
     if str(context.current_dt)[-8:] == '14:30:00':
@@ -83,10 +97,17 @@ def sell(context):
                 (current_data[s].last_price < current_data[s].high_limit)):
                 order_target_value(s, 0)
                 if current_data[s].last_price > context.portfolio.positions[s].avg_cost:
-                    print('止盈卖出', [get_security_info(s, date).display_name, s])
+                    take_profit.append(s)
+                    label = '止盈卖出'
                 else:
-                    print('止损卖出', [get_security_info(s, date).display_name, s])
-                print('———————————————————————————————————')
+                    stop_loss.append(s)
+                    label = '止损卖出'
+                if DEBUG_ORDERS:
+                    print(label, [_display_name(s, date), s])
+                    print('———————————————————————————————————')
+
+    log_orders('止盈卖出', take_profit, date)
+    log_orders('止损卖出', stop_loss, date)
 
 
 # ===================== Risk control =====================
@@ -94,16 +115,24 @@ def sell_if_limit_down_yesterday(context):
     positions = context.portfolio.positions
     yesterday = get_previous_trade_day(context, 1)
 
+    if not positions:
+        return
+
+    # one batched query for all holdings (09:30 is on the order-sending critical path)
+    df = get_price(list(positions), end_date=yesterday, count=1, frequency='daily',
+                   fields=['close', 'low', 'low_limit'], panel=False)
+    df = df.set_index('code') if df is not None and not df.empty else pd.DataFrame()
+
     for stock in positions:
         avg_cost = positions[stock].avg_cost
-        df = get_price(stock, end_date=yesterday, count=1, fields=['close', 'low', 'low_limit'])
-        if df is None or df.empty:
+        if stock not in df.index:
             log.warning('无法获取 {} 的价格数据'.format(stock))
             continue
 
-        close_price = df['close'].iloc[0]
-        low_price   = df['low'].iloc[0]
-        low_limit   = df['low_limit'].iloc[0]
+        bar = df.loc[stock]
+        close_price = bar['close']
+        low_price   = bar['low']
+        low_limit   = bar['low_limit']
 
         # one-word limit down yesterday
         if close_price == low_limit and low_price == low_limit:
@@ -118,199 +147,182 @@ def sell_if_limit_down_yesterday(context):
             log.info('股票 {} 亏损超过阈值，触发风控止损卖出'.format(stock))
 
 
-# ===================== Pool 1 =====================
-def prepare_stock_list(context):
+# ===================== Shared candidates =====================
+def prepare_shared_stock_list(context):
+    """
+    Filters common to both pools, run once per day as one vectorized pass.
+    Returns dict(stock_list, features) where `features` has one row per
+    surviving code with every column the pool rules need.
+    """
     date      = get_previous_trade_day(context, 0)   # today
     last_date = get_previous_trade_day(context, 1)   # yesterday
     last_last_date = get_previous_trade_day(context, 2)
 
-    stock_list = get_all_securities('stock', last_date).index.tolist()
-    stock_list = get_limit_up_stock(stock_list, last_date)          # yesterday limit-up
-    stock_list = filter_new_stock(stock_list, last_date)            # exclude very new stocks (60d)
-    stock_list = filter_st_stock(stock_list, last_date)             # your prior "non-ST" filter
-    stock_list = filter_stocks_by_opening_range(date, stock_list)   # opening window 1
-    stock_list = get_no_limit_up_stocks(last_last_date, 1, stock_list) # no limit-up in lookback (excl yesterday)
-    stock_list = get_relative_position_stocks(last_date, 15, stock_list) # low relative position
-    return stock_list
+    securities = get_all_securities('stock', last_date)
+    features = get_daily_features(securities, last_date)
 
+    listed_days = (pd.Timestamp(last_date) - features['start_date']).dt.days.to_numpy()
+    mask = (features['limit_up'].to_numpy(dtype=bool)   # yesterday limit-up
+            & (listed_days > 60))                        # exclude very new stocks (60d)
+    stock_list = features.index.to_numpy()[mask].tolist()
+    stock_list = get_no_limit_up_stocks(last_last_date, 1, stock_list) # no limit-up in lookback (excl yesterday)
 
-# ===================== Pool 2 =====================
-def prepare_stock_list2(context):
-    date      = get_previous_trade_day(context, 0)
-    last_date = get_previous_trade_day(context, 1)
-    last_last_date = get_previous_trade_day(context, 2)
-
-    stock_list = get_all_securities('stock', last_date).index.tolist()
-    stock_list = get_limit_up_stock2(stock_list, last_date)
-    stock_list = filter_new_stock2(stock_list, last_date)
-    stock_list = filter_st_stock2(stock_list, last_date)
-    stock_list = filter_stocks_by_opening_range2(date, stock_list)  # opening window 2
-    stock_list = get_no_limit_up_stocks2(last_last_date, 1, stock_list)
-    stock_list = get_relative_position_stocks2(last_date, 30, stock_list)
-    return stock_list
-
-
-# ===================== Utilities =====================
-def get_limit_up_stock(initial_list, date):
-    df = get_price(initial_list, end_date=date, frequency='daily',
-                   fields=['close', 'high', 'high_limit'], count=1,
-                   panel=False, fill_paused=False, skip_paused=False).dropna()
-    df = df[df['close'] == df['high_limit']]
-    hl_list = list(df.code)
-    return hl_list
-
-
-def filter_new_stock(initial_list, date, days=60):
-    return [stock for stock in initial_list if date - get_security_info(stock).start_date > dt.timedelta(days=days)]
-
-
-def filter_st_stock(stock_list, date):
-    filtered_stocks = []
-    for stock in stock_list:
-        try:
-            price_data = get_price(stock, end_date=date, count=2, frequency='daily', fields=['open', 'close'])
-            if len(price_data) == 2:
-                close_today = price_data['close'][-1]
-                close_yesterday = price_data['close'][-2]
-                return_percent_yesterday = (close_today - close_yesterday) / close_yesterday * 100
-
-                open_today = price_data['open'][-1]
-                return_percent_today = (close_today - open_today) / open_today * 100
-
-                # original rule: yesterday 4%~6% and close_today > 2.5
-                if 4 < return_percent_yesterday < 6 and close_today > 2.5:
-                    filtered_stocks.append(stock)
-        except Exception as e:
-            print("根据涨幅过滤ST出错 {}: {}".format(stock, e))
-    return filtered_stocks
-
-
-def filter_stocks_by_opening_range(date, code_list):
-    filtered_codes = []
-    for code in code_list:
-        stock_data = get_price(code, start_date=date, end_date=date, frequency='daily', fields=['open', 'pre_close'])
-        if stock_data.empty:
-            continue
-        open_price = stock_data['open'].iloc[0]
-        pre_close_price = stock_data['pre_close'].iloc[0]
-        open_change_ratio = (open_price - pre_close_price) / pre_close_price * 100
-        if g.open_min_1 <= open_change_ratio <= g.open_max_1:
-            filtered_codes.append(code)
-    return filtered_codes
-
-
-def get_no_limit_up_stocks(date, no_limit_date, code_list):
-    start_date = (pd.to_datetime(date) - pd.Timedelta(days=no_limit_date - 1)).strftime('%Y-%m-%d')
-    end_date = date
-    trading_days = get_trade_days(start_date=start_date, end_date=end_date)
-
-    no_limit_up_stocks = code_list.copy()
-    for day in trading_days:
-        if not no_limit_up_stocks:
-            break
-        stock_data = get_price(no_limit_up_stocks, end_date=day, frequency='daily',
-                               fields=['close', 'high', 'high_limit'], count=1, panel=False, fill_paused=False,
-                               skip_paused=False).dropna()
-        limit_up_stocks = stock_data[stock_data['close'] == stock_data['high_limit']]['code'].tolist()
-        no_limit_up_stocks = [code for code in no_limit_up_stocks if code not in limit_up_stocks]
-    return no_limit_up_stocks
-
-
-def get_relative_position_stocks(date, watch_days, code_list):
-    filtered_codes = []
-    for code in code_list:
-        data = get_price(code, end_date=date, count=watch_days, fields=['high', 'low'])
-        if data is None or data.empty:
-            continue
-        max_high = data['high'].max()
-        min_low = data['low'].min()
+    # today's open vs pre_close (%)
+    features = features.loc[stock_list].assign(open_change=get_opening_change(date, stock_list).reindex(stock_list))
+    return {'stock_list': stock_list, 'features': features}
 
-        close_price = get_price(code, end_date=date, count=1, fields=['close'])['close'].iloc[0]
-        if max_high == min_low:
-            continue
-        relative_position = (close_price - min_low) / (max_high - min_low)
 
-        if 0.0 <= relative_position <= 0.3:
-            filtered_codes.append(code)
-    return filtered_codes
+# ===================== Pools =====================
+# Per-pool thresholds; everything else in the pipeline is shared.
+#   return_min/max   : yesterday close-to-close return (%), exclusive
+#   min_close        : yesterday close must exceed this
+#   min_return_today : yesterday (close - open)/open (%) must exceed this
+#   open_min/max     : today's opening change (%), inclusive
+#   watch_days       : relative-position lookback
+#   max_position     : relative position upper bound
+PoolRule = namedtuple('PoolRule', ['return_min', 'return_max', 'min_close', 'min_return_today',
+                                   'open_min', 'open_max', 'watch_days', 'max_position'])
 
 
-# —— Pool 2 variants ——
-def get_limit_up_stock2(initial_list, date):
-    df = get_price(initial_list, end_date=date, frequency='daily',
-                   fields=['close', 'high', 'high_limit'], count=1,
-                   panel=False, fill_paused=False, skip_paused=False).dropna()
-    df = df[df['close'] == df['high_limit']]
-    hl_list = list(df.code)
-    return hl_list
+def get_pool_rules():
+    """Rules for pool 1 and pool 2 (opening windows read from g, see set_params)."""
+    pool1 = PoolRule(return_min=4, return_max=6, min_close=2.5, min_return_today=-np.inf,
+                     open_min=g.open_min_1, open_max=g.open_max_1, watch_days=15, max_position=0.3)
+    pool2 = PoolRule(return_min=9, return_max=22, min_close=-np.inf, min_return_today=5,
+                     open_min=g.open_min_2, open_max=g.open_max_2, watch_days=30, max_position=0.5)
+    return pool1, pool2
 
 
-def filter_new_stock2(initial_list, date, days=60):
-    return [stock for stock in initial_list if date - get_security_info(stock).start_date > dt.timedelta(days=days)]
+def _prepare_pool(context, rule, prefetched=None):
+    if prefetched is None:
+        prefetched = prepare_shared_stock_list(context)
+    last_date = get_previous_trade_day(context, 1)   # yesterday
 
+    f = prefetched['features']
+    ret_y = f['return_yesterday'].to_numpy()
+    opening = f['open_change'].to_numpy()
+    mask = ((ret_y > rule.return_min) & (ret_y < rule.return_max)              # your prior "non-ST" filter
+            & (f['close'].to_numpy() > rule.min_close)
+            & (f['return_today'].to_numpy() > rule.min_return_today)
+            & (opening >= rule.open_min) & (opening <= rule.open_max))         # opening window
+    stock_list = f.index.to_numpy()[mask].tolist()
+    stock_list = get_relative_position_stocks(last_date, rule.watch_days, stock_list,
+                                              rule.max_position)               # low relative position
+    return stock_list
 
-def filter_st_stock2(stock_list, date):
-    filtered_stocks = []
-    for stock in stock_list:
-        try:
-            price_data = get_price(stock, end_date=date, count=2, frequency='daily', fields=['open', 'close'])
-            if len(price_data) == 2:
-                close_today = price_data['close'][-1]
-                close_yesterday = price_data['close'][-2]
-                return_percent_yesterday = (close_today - close_yesterday) / close_yesterday * 100
 
-                open_today = price_data['open'][-1]
-                return_percent_today = (close_today - open_today) / open_today * 100
+def prepare_stock_list(context, prefetched=None):
+    return _prepare_pool(context, get_pool_rules()[0], prefetched)
 
-                # original rule for pool2: yesterday 9%~22% and today (close - open)/open > 5%
-                if 9 < return_percent_yesterday < 22 and return_percent_today > 5:
-                    filtered_stocks.append(stock)
-        except Exception as e:
-            print("根据涨幅过滤ST出错 {}: {}".format(stock, e))
-    return filtered_stocks
 
+def prepare_stock_list2(context, prefetched=None):
+    return _prepare_pool(context, get_pool_rules()[1], prefetched)
 
-def filter_stocks_by_opening_range2(date, code_list):
-    filtered_codes = []
-    for code in code_list:
-        stock_data = get_price(code, start_date=date, end_date=date, frequency='daily', fields=['open', 'pre_close'])
-        if stock_data.empty:
-            continue
-        open_price = stock_data['open'].iloc[0]
-        pre_close_price = stock_data['pre_close'].iloc[0]
-        open_change_ratio = (open_price - pre_close_price) / pre_close_price * 100
-        if g.open_min_2 <= open_change_ratio <= g.open_max_2:
-            filtered_codes.append(code)
-    return filtered_codes
 
+# ===================== Utilities =====================
+def get_daily_features(securities, date):
+    """
+    One row per code of `securities` (a get_all_securities frame) built from a
+    single two-bar query ending on `date`:
+      start_date, close, limit_up, return_yesterday (close-to-close %),
+      return_today (open-to-close % of the `date` bar).
+    """
+    bars = get_price(securities.index.tolist(), end_date=date, count=2, frequency='daily',
+                     fields=['open', 'close', 'high_limit', 'paused'], panel=False)
+    bars = bars.pivot(index='time', columns='code')   # codes without two full bars end up NaN
+    if len(bars) < 2:
+        return pd.DataFrame({'start_date': pd.Series(dtype='datetime64[ns]'),
+                             'close': pd.Series(dtype='float64'),
+                             'limit_up': pd.Series(dtype=bool),
+                             'return_yesterday': pd.Series(dtype='float64'),
+                             'return_today': pd.Series(dtype='float64')})
+
+    cur = bars.iloc[-1].unstack(level=0)
+    prev = bars.iloc[-2].unstack(level=0)
+    features = securities[['start_date']].reindex(cur.index)
+    features['close'] = cur['close']
+    # plain ndarray compares: no intermediate boolean Series / index alignment
+    features['limit_up'] = ((cur['paused'].to_numpy() == 0) &
+                            (cur['close'].to_numpy() == cur['high_limit'].to_numpy()))
+    features['return_yesterday'] = (cur['close'] - prev['close']) / prev['close'] * 100
+    features['return_today'] = (cur['close'] - cur['open']) / cur['open'] * 100
+    return features
+
+
+def get_opening_change(date, code_list):
+    """Opening change (%) vs pre_close for each code on `date`, one batched query."""
+    if not code_list:
+        return pd.Series(dtype='float64')
+    df = get_price(code_list, end_date=date, count=1, frequency='daily', fields=['open', 'pre_close'],
+                   panel=False, skip_paused=False).dropna()
+    ratio = (df['open'].values - df['pre_close'].values) / df['pre_close'].values * 100.0
+    return pd.Series(ratio, index=df['code'].values)
 
-def get_no_limit_up_stocks2(date, no_limit_date, code_list):
-    return get_no_limit_up_stocks(date, no_limit_date, code_list)
 
+def get_no_limit_up_stocks(date, no_limit_date, code_list):
+    if not code_list:
+        return []   # nothing left to check: skip the calendar and price RPCs
 
-def get_relative_position_stocks2(date, watch_days, code_list):
-    filtered_codes = []
-    for code in code_list:
-        data = get_price(code, end_date=date, count=watch_days, fields=['high', 'low'])
-        if data is None or data.empty:
-            continue
-        max_high = data['high'].max()
-        min_low = data['low'].min()
+    start_date = (pd.to_datetime(date) - pd.Timedelta(days=no_limit_date - 1)).strftime('%Y-%m-%d')
+    end_date = date
+    trading_days = get_trade_days(start_date=start_date, end_date=end_date)
+    if len(trading_days) == 0:
+        return list(code_list)
+
+    # whole lookback window in one query -> [T, N] limit-up flags -> any() over T
+    stock_data = get_price(code_list, start_date=trading_days[0], end_date=trading_days[-1], frequency='daily',
+                           fields=['close', 'high_limit'], panel=False, fill_paused=False,
+                           skip_paused=False)
+    stock_data = stock_data.pivot(index='time', columns='code')
+    ever_limit_up = np.any(stock_data['close'].values == stock_data['high_limit'].values, axis=0)
+    limit_up_stocks = set(stock_data['close'].columns[ever_limit_up])
+    return [code for code in code_list if code not in limit_up_stocks]
+
+
+def get_relative_position_stocks(date, watch_days, code_list, max_position=0.3):
+    if not code_list:
+        return []
+    # one query for the whole window, pivoted to [T, N] frames per field
+    data = get_price(code_list, end_date=date, count=watch_days, frequency='daily',
+                     fields=['high', 'low', 'close'], panel=False)
+    if data is None or data.empty:
+        return []
+    data = data.pivot(index='time', columns='code')
+    max_high = data['high'].max().values
+    min_low = data['low'].min().values
+    close_price = data['close'].values[-1]
+
+    price_range = max_high - min_low
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative_position = np.where(price_range > 0, (close_price - min_low) / price_range, np.nan)
+
+    mask = (relative_position >= 0.0) & (relative_position <= max_position)
+    kept = set(data['close'].columns[mask])
+    return [code for code in code_list if code in kept]   # keep input order
+
+
+# ===================== Caches =====================
+# Display names are looked up once per code per day and reused by every log line that day.
+@functools.lru_cache(maxsize=1024)
+def _display_name(code, date):
+    # keyed on date: names change over time (e.g. ST tags), so log the name as of that day
+    return get_security_info(code, date).display_name
 
-        close_price = get_price(code, end_date=date, count=1, fields=['close'])['close'].iloc[0]
-        if max_high == min_low:
-            continue
-        relative_position = (close_price - min_low) / (max_high - min_low)
 
-        if 0.0 <= relative_position <= 0.5:
-            filtered_codes.append(code)
-    return filtered_codes
+# ===================== Common helpers =====================
+def log_orders(action, codes, date):
+    """One summary log line per order batch, written after the orders are sent."""
+    if codes:
+        log.info('{} {}'.format(action, [[_display_name(s, date), s] for s in codes]))
 
 
-# ===================== Common helpers =====================
 def get_previous_trade_day(context, n):
     current_date = context.current_dt.date()
-    trade_days = get_trade_days(end_date=current_date, count=100)
+    # fetch the calendar once per trading day; buy/sell/risk control all reuse it
+    if getattr(g, '_td_date', None) != current_date:
+        g._trade_days = get_trade_days(end_date=current_date, count=100)
+        g._td_date = current_date
+    trade_days = g._trade_days
     if n > len(trade_days):
         return None
     return trade_days[-(n + 1)]